@@ -9,27 +9,73 @@ import re
 st.set_page_config(page_title="Code Smell Detector", layout="centered", initial_sidebar_state="expanded")
 st.title("Code Smell Detector by Gauri")
 
+# Patterns for pulling function names back out of the smell details.
+_PAT_FN = re.compile(r"Function (\w+)")
+_PAT_DUP = re.compile(r"Duplicate functions detected: (\w+)\s+and\s+(\w+)")
+_IN_FUNCS_PREFIX = "In functions "
+_IN_FUNCS_SUFFIX = ", duplicate block"
+
+@st.cache_resource
+def _lexer_and_formatter():
+    """
+    Pygments lexer and formatter, built once and shared across reruns.
+    """
+    return PythonLexer(), HtmlFormatter(nowrap=True)
+
+@st.cache_data
+def _style_defs():
+    """
+    CSS for the Pygments formatter, which never changes between reruns.
+    """
+    _, formatter = _lexer_and_formatter()
+    return formatter.get_style_defs('.highlight')
+
+@st.cache_data
 def highlight_code(code, snippets):
     """
     Highlight the code using Pygments and wrap each "snippet" with a yellow background. Returns HTML to display.
+    Cached on (code, snippets), so pass snippets as a tuple; reruns on the same upload skip Pygments entirely.
     """
     # Generate HTML highlighted code.
-    formatter = HtmlFormatter(nowrap=True)
-    highlighted_code = highlight(code, PythonLexer(), formatter)
-    # For each snippet, wrap its occurrences with a yellow span.
-    for snippet in snippets:
-        pattern = re.escape(snippet)
-        # Wrap with <span> having yellow background.
-        highlighted_code = re.sub(
-            pattern,
-            f'<span style="background-color: yellow; font-weight: bold;">{snippet}</span>',
+    lexer, formatter = _lexer_and_formatter()
+    highlighted_code = highlight(code, lexer, formatter)
+    # Wrap every snippet occurrence with a yellow span in a single pass.
+    # Longest first, so a short name never matches inside a longer one.
+    if snippets:
+        pattern = re.compile("|".join(re.escape(s) for s in sorted(snippets, key=len, reverse=True)))
+        highlighted_code = pattern.sub(
+            lambda m: f'<span style="background-color: yellow; font-weight: bold;">{m.group(0)}</span>',
             highlighted_code
         )
     # Wrap in a <pre> tag to mimic st.code styling.
-    style = f"<style>{formatter.get_style_defs('.highlight')}</style>"
+    style = f"<style>{_style_defs()}</style>"
     html_code = f"{style}<pre class='highlight'>{highlighted_code}</pre>"
     return html_code
 
+@st.cache_data(show_spinner=False)
+def analyze_code(raw):
+    """
+    Parse the uploaded bytes once and run every detector on the tree.
+    Returns (results, errors): a failing detector reports an empty result and its message instead of stopping the others.
+    """
+    refactorer = Refactoring()
+    tree = refactorer.parse(raw)
+    detectors = {
+        "long_methods": refactorer.detect_long_methods,
+        "long_params": refactorer.detect_long_parameter_list,
+        "duplicate_funcs": refactorer.detect_duplicate_functions,
+        "duplicate_blocks": refactorer.detect_duplicate_blocks,
+    }
+    results = {}
+    errors = []
+    for key, detector in detectors.items():
+        try:
+            results[key] = detector(raw, tree=tree)
+        except Exception as e:
+            results[key] = []
+            errors.append(str(e))
+    return results, errors
+
 def main():
     st.markdown("""
         **Welcome to the Code Refactor Tool! Let’s streamline your code :)**
@@ -47,79 +93,75 @@ def main():
         st.warning("Please upload a .py file.")
         return
 
+    # Keep the raw bytes for analysis; the decoded text is only needed for display and refactoring.
+    raw = uploaded_file.read()
     try:
-        code = uploaded_file.read().decode("utf-8")
+        code = raw.decode("utf-8")
     except Exception as e:
         st.error(f"Error reading file: {e}")
         return
 
-    refactorer = Refactoring()
-    detected_smells = []
-
-    # Detect long methods.
+    # Detection is cached on the upload, so reruns with the same file skip re-analysis.
     try:
-        long_methods = refactorer.detect_long_methods(code)
-        if long_methods:
-            details = [f"Function {name} has {count} non-empty lines." for name, count in long_methods]
-            detected_smells.append({"type": "Long Method", "details": details})
+        results, detector_errors = analyze_code(raw)
     except Exception as e:
         st.error(str(e))
+        return
+    for error in detector_errors:
+        st.error(error)
+    detected_smells = []
+
+    # Detect long methods.
+    long_methods = results["long_methods"]
+    if long_methods:
+        details = [f"Function {name} has {count} non-empty lines." for name, count in long_methods]
+        detected_smells.append({"type": "Long Method", "details": details})
 
     # Detect long parameter lists.
-    try:
-        long_params = refactorer.detect_long_parameter_list(code)
-        if long_params:
-            details = [f"Function {name} has {count} parameters." for name, count in long_params]
-            detected_smells.append({"type": "Long Parameter List", "details": details})
-    except Exception as e:
-        st.error(str(e))
+    long_params = results["long_params"]
+    if long_params:
+        details = [f"Function {name} has {count} parameters." for name, count in long_params]
+        detected_smells.append({"type": "Long Parameter List", "details": details})
 
     # Detect duplicate code
-    try:
-        duplicate_funcs = refactorer.detect_duplicate_functions(code)
-        if duplicate_funcs:
-            details = [f"Duplicate functions detected: {primary} and {dup}" for primary, dup in duplicate_funcs]
-            detected_smells.append({"type": "Duplicate Function", "details": details})
-    except Exception as e:
-        st.error(str(e))
-    
-    try:
-        duplicate_blocks = refactorer.detect_duplicate_blocks(code)
-        if duplicate_blocks:
-            details = []
-            for group in duplicate_blocks:
-                func_names = sorted({occ[0] for occ in group})
-                indices = sorted({str(occ[1]) for occ in group})
-                details.append(f"In functions {', '.join(func_names)}, duplicate block starts at indices: {', '.join(indices)}")
-            detected_smells.append({"type": "Duplicate Block", "details": details})
-    except Exception as e:
-        st.error(str(e))
+    duplicate_funcs = results["duplicate_funcs"]
+    if duplicate_funcs:
+        details = [f"Duplicate functions detected: {primary} and {dup}" for primary, dup in duplicate_funcs]
+        detected_smells.append({"type": "Duplicate Function", "details": details})
+
+    duplicate_blocks = results["duplicate_blocks"]
+    if duplicate_blocks:
+        details = []
+        for group in duplicate_blocks:
+            func_names = sorted({occ[0] for occ in group})
+            indices = sorted({str(occ[1]) for occ in group})
+            details.append(f"In functions {', '.join(func_names)}, duplicate block starts at indices: {', '.join(indices)}")
+        detected_smells.append({"type": "Duplicate Block", "details": details})
     
     # Highlight Code smells
-    smell_snippets = []
+    smell_snippets = set()
     for smell in detected_smells:
         for detail in smell["details"]:
-            m = re.search(r"Function (\w+)", detail)
+            m = _PAT_FN.search(detail)
             if m:
-                smell_snippets.append(m.group(1))
-            m = re.search(r"Duplicate functions detected: (\w+)\s+and\s+(\w+)", detail)
+                smell_snippets.add(m.group(1))
+            m = _PAT_DUP.search(detail)
             if m:
-                smell_snippets.append(m.group(1))
-                smell_snippets.append(m.group(2))
-            m = re.search(r"In functions ([\w,\s]+),", detail)
-            if m:
-                names = m.group(1).split(',')
-                smell_snippets.extend(name.strip() for name in names if name.strip())
-    smell_snippets = list(set(smell_snippets))
-    
-    highlighted_uploaded_code = highlight_code(code, smell_snippets)
+                smell_snippets.add(m.group(1))
+                smell_snippets.add(m.group(2))
+            if detail.startswith(_IN_FUNCS_PREFIX):
+                names = detail[len(_IN_FUNCS_PREFIX):].partition(_IN_FUNCS_SUFFIX)[0].split(',')
+                smell_snippets.update(name.strip() for name in names if name.strip())
     
-    # Display the highlighted code in the sidebar
+    # Display the uploaded code in the sidebar, rendered once: highlighted when there are smells, plain otherwise.
     with st.sidebar:
         st.title("Uploaded Code")
-        st.code(code, language="python")
-        st.markdown("### Uploaded Code with Highlights")
-        components.html(highlighted_uploaded_code, height=400, scrolling=True)
+        if smell_snippets:
+            highlighted_uploaded_code = highlight_code(code, tuple(sorted(smell_snippets)))
+            st.markdown("### Uploaded Code with Highlights")
+            components.html(highlighted_uploaded_code, height=400, scrolling=True)
+        else:
+            st.code(code, language="python")
     
     st.markdown('<div class="chat-container">', unsafe_allow_html=True)
     st.info("Analyzing Code...")
@@ -154,6 +196,7 @@ def main():
     if duplicate_funcs or duplicate_blocks:
         if st.button("Refactor Code"):
             try:
+                refactorer = Refactoring()
                 refactored_code = code
                 if duplicate_funcs:
                     refactored_code = refactorer.refactor_duplicate_functions(refactored_code, duplicate_funcs)
@@ -1,74 +1,153 @@
 import ast
+import concurrent.futures
+import functools
+import hashlib
+import itertools
+import math
+import re
+import sys
 import google.generativeai as genai
 import os
 
+# Whitespace around a line break, including blank lines in between.
+_LINE_EDGE_WHITESPACE = re.compile(r"\s*\n\s*")
+
+@functools.lru_cache(maxsize=None)
+def _naming_model():
+    """
+    Configure Gemini and build the naming model once per process.
+    Called before any worker threads start, since genai.configure resets the library's global client.
+    """
+    genai.configure(api_key="")
+    return genai.GenerativeModel("gemini-1.5-flash")
+
+@functools.lru_cache(maxsize=512)
+def _suggest_helper_name(code_snippet):
+    """
+    Ask the model for a snake case helper name for the snippet. Module-level so repeat Refactor clicks reuse the names.
+    Raises ValueError when the reply is not an identifier; lru_cache does not cache exceptions, so a bad reply is retried.
+    """
+    prompt = (
+        "Analyze the given Python code snippet and return only a meaningful function name in snake case. "
+        "Do not include explanations or extra text. Just return a valid Python function name in snake case.\n\n"
+        f"Code:\n{code_snippet}"
+    )
+    response = _naming_model().generate_content(prompt)
+    suggested_name = response.text.strip().split("\n")[0]
+    suggested_name = suggested_name.replace("`", "").strip()
+    if not suggested_name.isidentifier():
+        raise ValueError(f"Model suggested an invalid function name: {suggested_name!r}")
+    return suggested_name
+
+class _DisjointSet:
+    """
+    Union-find over the integers 0..n-1, with path halving and union by size.
+    """
+    def __init__(self, n):
+        self.parent = list(range(n))
+        self.size = [1] * n
+
+    def find(self, i):
+        parent = self.parent
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    def union(self, i, j):
+        root_i, root_j = self.find(i), self.find(j)
+        if root_i == root_j:
+            return
+        if self.size[root_i] < self.size[root_j]:
+            root_i, root_j = root_j, root_i
+        self.parent[root_j] = root_i
+        self.size[root_i] += self.size[root_j]
+
 class Refactoring:
+    def __init__(self):
+        self._parsed_trees = {}
+        self._funcdefs = {}
+        self._unparsed = {}
+
+    def parse(self, code):
+        """
+        Parse the code once and reuse the tree for every detector run on the same input.
+        Accepts str or the raw uploaded bytes. The cached tree is shared, so detectors must not mutate it.
+        """
+        source = code if isinstance(code, bytes) else code.encode("utf-8")
+        key = hashlib.sha1(source).digest()
+        tree = self._parsed_trees.get(key)
+        if tree is None:
+            try:
+                tree = ast.parse(code)
+            except Exception as e:
+                raise Exception(f"Could not parse file: {e}")
+            self._parsed_trees[key] = tree
+        return tree
+
     # ----------------------------------------------------------------
     # Basic Code Smell Detectors
     # ----------------------------------------------------------------
-    def detect_long_methods(self, code, threshold=15):
+    def detect_long_methods(self, code, threshold=15, tree=None):
         lines = code.splitlines(keepends=True)
-        try:
-            tree = ast.parse(code)
-        except Exception as e:
-            raise Exception(f"Could not parse file: {e}")
+        if tree is None:
+            tree = self.parse(code)
+
+        # non_empty_prefix[k] is the number of non-empty lines in lines[:k].
+        non_empty_prefix = [0]
+        non_empty_prefix.extend(itertools.accumulate(1 if line.strip() else 0 for line in lines))
 
         long_methods = []
-        for node in ast.walk(tree):
-            if isinstance(node, ast.FunctionDef):
-                if not hasattr(node, "end_lineno"):
-                    raise Exception("Your Python version does not support 'end_lineno'. Please use Python 3.8 or higher.")
-                start_line = node.lineno - 1  # 0-indexed
-                end_line = node.end_lineno     # 1-indexed (exclusive)
-                function_lines = lines[start_line:end_line]
-                non_empty_lines = [line for line in function_lines if line.strip() != ""]
-                if len(non_empty_lines) > threshold:
-                    long_methods.append((node.name, len(non_empty_lines)))
+        for node, _ in self._collect_funcdefs(tree):
+            if not hasattr(node, "end_lineno"):
+                raise Exception("Your Python version does not support 'end_lineno'. Please use Python 3.8 or higher.")
+            start_line = min(node.lineno - 1, len(lines))  # 0-indexed
+            end_line = min(node.end_lineno, len(lines))    # 1-indexed (exclusive)
+            non_empty_count = non_empty_prefix[end_line] - non_empty_prefix[start_line]
+            if non_empty_count > threshold:
+                long_methods.append((node.name, non_empty_count))
         return long_methods
 
-    def detect_long_parameter_list(self, code, threshold=3):
-        try:
-            tree = ast.parse(code)
-        except Exception as e:
-            raise Exception(f"Could not parse file: {e}")
+    def detect_long_parameter_list(self, code, threshold=3, tree=None):
+        if tree is None:
+            tree = self.parse(code)
 
         long_params = []
-        for node in ast.walk(tree):
-            if isinstance(node, ast.FunctionDef):
-                param_count = len(node.args.args)
-                if param_count > threshold:
-                    long_params.append((node.name, param_count))
+        for node, _ in self._collect_funcdefs(tree):
+            param_count = len(node.args.args)
+            if param_count > threshold:
+                long_params.append((node.name, param_count))
         return long_params
 
     # ----------------------------------------------------------------
     # Duplicate Function Detection and Refactoring (Function-Level)
     # ----------------------------------------------------------------
-    def detect_duplicate_functions(self, code, similarity_threshold=0.75):
+    def detect_duplicate_functions(self, code, similarity_threshold=0.75, tree=None):
         """
         Detect duplicate functions based on identical function bodies.
         Ignores the function signature and compares the unparsed bodies.
         """
-        try:
-            tree = ast.parse(code)
-        except Exception as e:
-            raise Exception(f"Could not parse file: {e}")
+        if tree is None:
+            tree = self.parse(code)
         
         function_map = {}
         duplicates = []
         # Process top-level function definitions.
-        for node in tree.body:
-            if isinstance(node, ast.FunctionDef):
-                try:
-                    # Unparse the function body (ignore the signature)
-                    func_body_code = "\n".join([ast.unparse(n) for n in node.body])
-                except Exception:
-                    func_body_code = ""
-                # Normalize by stripping extra whitespace.
-                normalized_body = "\n".join(line.strip() for line in func_body_code.splitlines() if line.strip())
-                if normalized_body in function_map:
-                    duplicates.append((function_map[normalized_body], node.name))
-                else:
-                    function_map[normalized_body] = node.name
+        for node, is_top_level in self._collect_funcdefs(tree):
+            if not is_top_level:
+                continue
+            try:
+                # Unparse the function body (ignore the signature)
+                func_body_code = "\n".join([self._unparse(n) for n in node.body])
+            except Exception:
+                func_body_code = ""
+            # Normalize by stripping extra whitespace, then key on a short digest instead of the body text.
+            normalized_body = _LINE_EDGE_WHITESPACE.sub("\n", func_body_code).strip()
+            body_key = hashlib.blake2b(normalized_body.encode("utf-8"), digest_size=16).digest()
+            if body_key in function_map:
+                duplicates.append((function_map[body_key], node.name))
+            else:
+                function_map[body_key] = node.name
         return duplicates
 
     def refactor_duplicate_functions(self, code, duplicate_pairs):
@@ -113,78 +192,131 @@ class Refactoring:
     # ----------------------------------------------------------------
     # Duplicate Block Detection and Refactoring (Block-Level)
     # ----------------------------------------------------------------
-    def detect_duplicate_blocks(self, code, window_size=2, similarity_threshold=0.75):
-        try:
-            tree = ast.parse(code)
-        except Exception as e:
-            raise Exception(f"Could not parse file: {e}")
+    def detect_duplicate_blocks(self, code, window_size=2, similarity_threshold=0.75, tree=None):
+        if tree is None:
+            tree = self.parse(code)
         
         blocks_list = []
-        for node in tree.body:
-            if isinstance(node, ast.FunctionDef):
-                func_name = node.name
-                body = node.body
-                if len(body) < window_size:
-                    continue
-                for i in range(len(body) - window_size + 1):
-                    block_nodes = body[i:i+window_size]
-                    try:
-                        block_code = "\n".join([ast.unparse(n) for n in block_nodes])
-                    except Exception:
-                        block_code = ""
-                    tokens = set(block_code.split())
-                    blocks_list.append((func_name, i, block_code, tokens))
-        
-        groups = []
-        used = set()
-        n = len(blocks_list)
-        for i in range(n):
-            if i in used:
+        for node, is_top_level in self._collect_funcdefs(tree):
+            if not is_top_level:
                 continue
-            group = [blocks_list[i]]
-            used.add(i)
-            for j in range(i+1, n):
-                if blocks_list[i][0] == blocks_list[j][0]:
+            func_name = node.name
+            body = node.body
+            if len(body) < window_size:
+                continue
+            # Unparse each statement once; overlapping windows reuse the text.
+            per_stmt = []
+            for stmt in body:
+                try:
+                    per_stmt.append(self._unparse(stmt))
+                except Exception:
+                    per_stmt.append(None)
+            for i in range(len(body) - window_size + 1):
+                block_stmts = per_stmt[i:i+window_size]
+                block_code = "" if None in block_stmts else "\n".join(block_stmts)
+                tokens = frozenset(sys.intern(t) for t in block_code.split())
+                blocks_list.append((func_name, i, block_code, tokens))
+        
+        # Only pairs that can reach the threshold are compared, instead of every pair.
+        candidates = self._candidate_pairs([block[3] for block in blocks_list], similarity_threshold)
+
+        # Union similar pairs in source order; groups are the resulting components, so a member may only be
+        # similar to another member rather than to the first one. refactor_duplicate_blocks rechecks each
+        # member against the representative before replacing it.
+        components = _DisjointSet(len(blocks_list))
+        # Function names per component root. A component holds at most one block per function,
+        # otherwise refactoring would replace overlapping windows of the same body.
+        root_funcs = [{block[0]} for block in blocks_list]
+        for i, block_i in enumerate(blocks_list):
+            tokens_i = block_i[3]
+            for j in candidates[i]:
+                if block_i[0] == blocks_list[j][0]:
                     continue  # ignore blocks from the same function
-                if j in used:
-                    continue
-                tokens_i = blocks_list[i][3]
+                root_i, root_j = components.find(i), components.find(j)
+                if root_i == root_j or not root_funcs[root_i].isdisjoint(root_funcs[root_j]):
+                    continue  # already grouped, or the merge would put two blocks of one function together
                 tokens_j = blocks_list[j][3]
                 if tokens_i and tokens_j:
-                    intersection = tokens_i.intersection(tokens_j)
-                    union = tokens_i.union(tokens_j)
-                    similarity = len(intersection) / len(union) if union else 0
+                    # Jaccard can't exceed smaller / larger, so lopsided pairs are skipped outright.
+                    if min(len(tokens_i), len(tokens_j)) < similarity_threshold * max(len(tokens_i), len(tokens_j)):
+                        continue
+                    # |A | B| = |A| + |B| - |A & B|, so the union set is never built.
+                    intersection = len(tokens_i & tokens_j)
+                    similarity = intersection / (len(tokens_i) + len(tokens_j) - intersection)
                     if similarity >= similarity_threshold:
-                        group.append(blocks_list[j])
-                        used.add(j)
-            if len(group) > 1:
-                groups.append(group)
+                        components.union(i, j)
+                        root_funcs[components.find(i)] = root_funcs[root_i] | root_funcs[root_j]
+
+        # Bucket by root; dicts keep insertion order, so groups and their members stay in source order.
+        buckets = {}
+        for i, block in enumerate(blocks_list):
+            buckets.setdefault(components.find(i), []).append(block)
+        groups = [group for group in buckets.values() if len(group) > 1]
         return groups
 
-    def refactor_duplicate_blocks(self, code, duplicate_block_groups, window_size=2):
+    def refactor_duplicate_blocks(self, code, duplicate_block_groups, window_size=2, similarity_threshold=0.75):
         try:
             tree = ast.parse(code)
         except Exception as e:
             raise Exception(f"Could not parse file for refactoring duplicate blocks: {e}")
 
+        # Settle which groups get replaced before asking for names, so skipped groups cost no LLM call.
+        # Statement indices already claimed per function.
+        replaced = {}
+        selected_groups = []
+        for group in duplicate_block_groups:
+            # Two windows of one function in a group would overlap, and deleting both would drop code.
+            group_func_names = [occurrence[0] for occurrence in group]
+            if len(set(group_func_names)) != len(group_func_names):
+                raise Exception("Duplicate block group contains more than one block from the same function.")
+            # Chained members get the representative's code, so only keep those that reach the threshold against it.
+            rep_tokens = group[0][3]
+            group = [group[0]] + [
+                occurrence for occurrence in group[1:]
+                if len(rep_tokens & occurrence[3]) >= similarity_threshold * len(rep_tokens | occurrence[3])
+            ]
+            if len(group) < 2:
+                continue
+            # Skip a group whose windows overlap ones an earlier group already replaces.
+            windows = [(occurrence[0], range(occurrence[1], occurrence[1] + window_size)) for occurrence in group]
+            if any(not replaced.get(func_name, set()).isdisjoint(span) for func_name, span in windows):
+                continue
+            for func_name, span in windows:
+                replaced.setdefault(func_name, set()).update(span)
+            selected_groups.append(group)
+
         global_new_funcs = {}
+        # Call sites to splice in once every group is built.
+        call_sites = []
 
-        for group in duplicate_block_groups:
+        # Ask for all helper names up front and concurrently; the LLM round-trips dominate otherwise.
+        rep_codes = list(dict.fromkeys(group[0][2] for group in selected_groups))
+        if rep_codes:
+            _naming_model()  # configure the client on this thread, before any worker uses it
+        with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+            suggested_names = dict(zip(rep_codes, executor.map(self.analyze_block_functionality, rep_codes)))
+
+        # Index top-level functions by name once; the first definition wins, as with a linear scan.
+        funcs = {}
+        for node in tree.body:
+            if isinstance(node, ast.FunctionDef):
+                funcs.setdefault(node.name, node)
+
+        for group in selected_groups:
             # Use the first occurrence as representative.
             rep_func_name, rep_index, rep_block_code, rep_tokens = group[0]
-            free_vars = None
-            # Find the representative function node and compute free vars.
-            for node in tree.body:
-                if isinstance(node, ast.FunctionDef) and node.name == rep_func_name:
-                    block_nodes = node.body[rep_index:rep_index+window_size]
-                    free_vars = self.get_free_vars(block_nodes)
-                    break
-            if free_vars is None:
+            rep_node = funcs.get(rep_func_name)
+            # Compute free vars from the representative function node.
+            if rep_node is not None:
+                free_vars = self.get_free_vars(rep_node.body[rep_index:rep_index+window_size])
+            else:
                 free_vars = set()
+            # Sort once per group; the helper signature and every call site share this order.
+            arg_names = sorted(free_vars)
 
             args = ast.arguments(
                 posonlyargs=[],
-                args=[ast.arg(arg=v) for v in sorted(free_vars)],
+                args=[ast.arg(arg=v) for v in arg_names],
                 vararg=None,
                 kwonlyargs=[],
                 kw_defaults=[],
@@ -192,7 +324,7 @@ class Refactoring:
                 defaults=[]
             )
 
-            candidate = self.analyze_block_functionality(rep_block_code)
+            candidate = suggested_names[rep_block_code]
             new_func_name = candidate
             suffix = 1
             while new_func_name in global_new_funcs:
@@ -201,13 +333,7 @@ class Refactoring:
             global_new_funcs[new_func_name] = new_func_name
 
             # Extract the helper body from the representative occurrence.
-            helper_body = None
-            for node in tree.body:
-                if isinstance(node, ast.FunctionDef) and node.name == rep_func_name:
-                    helper_body = node.body[rep_index:rep_index+window_size]
-                    break
-            if helper_body is None:
-                helper_body = []
+            helper_body = rep_node.body[rep_index:rep_index+window_size] if rep_node is not None else []
 
             if not helper_body or not isinstance(helper_body[-1], ast.Return):
                 if helper_body and isinstance(helper_body[0], ast.Assign) and helper_body[0].targets:
@@ -228,44 +354,33 @@ class Refactoring:
             # Replace each occurrence of the duplicate block with a call to the helper.
             for occurrence in group:
                 func_name, start_index, block_code, tokens = occurrence
-                for node in tree.body:
-                    if isinstance(node, ast.FunctionDef) and node.name == func_name:
-                        # Capture return value from a call to newly created helper function to replace duplicate code
-                        if start_index < len(node.body) and isinstance(node.body[start_index], ast.Assign):
-                            assign_stmt = node.body[start_index]
-                            if assign_stmt.targets and isinstance(assign_stmt.targets[0], ast.Name):
-                                var_name = assign_stmt.targets[0].id
-                                new_stmt = ast.Assign(
-                                    targets=[ast.Name(id=var_name, ctx=ast.Store())],
-                                    value=ast.Call(
-                                        func=ast.Name(id=new_func_name, ctx=ast.Load()),
-                                        args=[ast.Name(id=v, ctx=ast.Load()) for v in sorted(free_vars)],
-                                        keywords=[]
-                                    )
-                                )
-                            else:
-                                new_stmt = ast.Expr(
-                                    value=ast.Call(
-                                        func=ast.Name(id=new_func_name, ctx=ast.Load()),
-                                        args=[ast.Name(id=v, ctx=ast.Load()) for v in sorted(free_vars)],
-                                        keywords=[]
-                                    )
-                                )
+                node = funcs.get(func_name)
+                if node is not None:
+                    # Each call site gets its own nodes; AST nodes must not be shared between locations.
+                    call = ast.Call(
+                        func=ast.Name(id=new_func_name, ctx=ast.Load()),
+                        args=[ast.Name(id=v, ctx=ast.Load()) for v in arg_names],
+                        keywords=[]
+                    )
+                    # Capture return value from a call to newly created helper function to replace duplicate code
+                    if start_index < len(node.body) and isinstance(node.body[start_index], ast.Assign):
+                        assign_stmt = node.body[start_index]
+                        if assign_stmt.targets and isinstance(assign_stmt.targets[0], ast.Name):
+                            var_name = assign_stmt.targets[0].id
+                            new_stmt = ast.Assign(targets=[ast.Name(id=var_name, ctx=ast.Store())], value=call)
                         else:
-                            new_stmt = ast.Expr(
-                                value=ast.Call(
-                                    func=ast.Name(id=new_func_name, ctx=ast.Load()),
-                                    args=[ast.Name(id=v, ctx=ast.Load()) for v in sorted(free_vars)],
-                                    keywords=[]
-                                )
-                            )
-                        del node.body[start_index:start_index+window_size]
-                        node.body.insert(start_index, new_stmt)
-                        break
+                            new_stmt = ast.Expr(value=call)
+                    else:
+                        new_stmt = ast.Expr(value=call)
+                    call_sites.append((node, start_index, new_stmt))
 
             # Append the new helper function
             tree.body.append(new_helper)
 
+        # Splice bottom-up so the recorded indices still point at the original statements.
+        for node, start_index, new_stmt in sorted(call_sites, key=lambda site: site[1], reverse=True):
+            node.body[start_index:start_index+window_size] = [new_stmt]
+
         tree = ast.fix_missing_locations(tree)
         try:
             refactored_code = ast.unparse(tree)
@@ -276,20 +391,75 @@ class Refactoring:
     # ----------------------------------------------------------------
     # Helper Methods
     # ----------------------------------------------------------------
+    def _collect_funcdefs(self, tree):
+        """
+        Return [(node, is_top_level), ...] for every FunctionDef in the tree, in source order.
+        Collected with a single walk and cached per tree so the detectors don't each re-walk it.
+        """
+        cached = self._funcdefs.get(id(tree))
+        if cached is not None and cached[0] is tree:
+            return cached[1]
+        funcdefs = []
+        stack = [(child, True) for child in reversed(tree.body)]
+        while stack:
+            node, is_top_level = stack.pop()
+            if isinstance(node, ast.FunctionDef):
+                funcdefs.append((node, is_top_level))
+            stack.extend((child, False) for child in reversed(list(ast.iter_child_nodes(node))))
+        self._funcdefs[id(tree)] = (tree, funcdefs)
+        return funcdefs
+
+    def _candidate_pairs(self, token_sets, similarity_threshold):
+        """
+        Return, for each token set, the sorted indices of later sets that may reach the Jaccard threshold.
+        Uses prefix filtering: with tokens ordered rarest-first, two sets with similarity >= threshold
+        must share a token within each set's first len - ceil(threshold * len) + 1 tokens. Exact, no false negatives.
+        """
+        frequency = {}
+        for tokens in token_sets:
+            for token in tokens:
+                frequency[token] = frequency.get(token, 0) + 1
+
+        index = {}
+        candidates = [set() for _ in token_sets]
+        for i, tokens in enumerate(token_sets):
+            if not tokens:
+                continue
+            ordered = sorted(tokens, key=lambda t: (frequency[t], t))
+            prefix_len = len(ordered) - math.ceil(similarity_threshold * len(ordered) - 1e-9) + 1
+            for token in ordered[:prefix_len]:
+                for j in index.setdefault(token, []):
+                    candidates[j].add(i)
+                index[token].append(i)
+        return [sorted(c) for c in candidates]
+
+    def _unparse(self, node):
+        """
+        Memoized ast.unparse, keyed by node identity.
+        """
+        cached = self._unparsed.get(id(node))
+        if cached is not None and cached[0] is node:
+            return cached[1]
+        source = ast.unparse(node)
+        self._unparsed[id(node)] = (node, source)
+        return source
+
     def get_free_vars(self, nodes):
         """
         Return variables used (loaded) in nodes that are not assigned (stored) in them.
         """
         free_vars = set()
         assigned = set()
-        class FreeVarVisitor(ast.NodeVisitor):
-            def visit_Name(self, n):
+        # Walk every node with one explicit stack rather than a visitor per statement.
+        stack = list(nodes)
+        while stack:
+            n = stack.pop()
+            if isinstance(n, ast.Name):
                 if isinstance(n.ctx, ast.Load):
                     free_vars.add(n.id)
                 elif isinstance(n.ctx, ast.Store):
                     assigned.add(n.id)
-        for node in nodes:
-            FreeVarVisitor().visit(node)
+            stack.extend(ast.iter_child_nodes(n))
         return free_vars - assigned
 
     def analyze_block_functionality(self, code_snippet):
@@ -298,18 +468,9 @@ class Refactoring:
         Use Gemini 1.5 Flash to generate a candidate helper function name in snake case based on the provided code snippet.
         As this is a small model, it did not take much time to run.
         I used prompt engineering to use this model for naming functions.
+        Names are cached per snippet by _suggest_helper_name; an invalid reply falls back to "common_block" and is not cached.
         """
-        genai.configure(api_key="")
-        model = genai.GenerativeModel("gemini-1.5-flash")
-        prompt = (
-            "Analyze the given Python code snippet and return only a meaningful function name in snake case. "
-            "Do not include explanations or extra text. Just return a valid Python function name in snake case.\n\n"
-            f"Code:\n{code_snippet}"
-        )
-        response = model.generate_content(prompt)
-        suggested_name = response.text.strip().split("\n")[0]
-        suggested_name = suggested_name.replace("`", "").strip()
-        if suggested_name.isidentifier():
-            return suggested_name
-        else:
-            return "common_block"
\ No newline at end of file
+        try:
+            return _suggest_helper_name(code_snippet)
+        except ValueError:
+            return "common_block"
@@ -1,46 +1,59 @@
 import streamlit as st
 import ast
 import difflib
+from itertools import combinations
 
 
 class SemanticDuplicateDetector:
     def __init__(self):
-        pass
+        self._normalized = {}
 
     def are_functions_semantically_duplicate(self, func_code1, func_code2):
         """
         Compare two function codes and return True if they do the same thing, ignoring names and spaces.
         """
+        threshold = 0.80  # Consider 80% similarity as the threshold for semantic duplication
         # Strip out variable names and whitespace, focus on operations
         normalized_code1 = self.normalize_code(func_code1)
         normalized_code2 = self.normalize_code(func_code2)
-        
+
+        # The ratio is 2 * matches / total length, so it can never exceed 2 * shorter / total.
+        # Skip the matcher when even that upper bound misses the threshold.
+        total_length = len(normalized_code1) + len(normalized_code2)
+        if total_length and 2 * min(len(normalized_code1), len(normalized_code2)) / total_length <= threshold:
+            return False
+
         similarity_ratio = self.calculate_similarity(normalized_code1, normalized_code2)
-        return similarity_ratio > 0.80  # Consider 80% similarity as the threshold for semantic duplication
+        return similarity_ratio > threshold
 
     def normalize_code(self, code):
         """
         Simplify the code by removing variable names and making the structure simpler, focusing only on the operations.
+        Results are cached per code string, since every function is compared against all the others.
         """
-        tree = ast.parse(code)
-        normalized_code = []
-
-        for node in ast.walk(tree):
-            if isinstance(node, ast.FunctionDef):
-                normalized_code.append("def " + node.name + "()")
-            elif isinstance(node, ast.If):
-                normalized_code.append("if condition:")
-            elif isinstance(node, ast.For):
-                normalized_code.append("for item in iterable:")
-            elif isinstance(node, ast.BinOp):
-                normalized_code.append("binary operation")
-            elif isinstance(node, ast.Call):
-                normalized_code.append("function call")
-            elif isinstance(node, ast.Assign):
-                normalized_code.append("assignment")
-            # You can add more logic here to normalize other structures
-
-        return " ".join(normalized_code)
+        normalized_code = self._normalized.get(code)
+        if normalized_code is None:
+            tree = ast.parse(code)
+            parts = []
+
+            for node in ast.walk(tree):
+                if isinstance(node, ast.FunctionDef):
+                    parts.append("def " + node.name + "()")
+                elif isinstance(node, ast.If):
+                    parts.append("if condition:")
+                elif isinstance(node, ast.For):
+                    parts.append("for item in iterable:")
+                elif isinstance(node, ast.BinOp):
+                    parts.append("binary operation")
+                elif isinstance(node, ast.Call):
+                    parts.append("function call")
+                elif isinstance(node, ast.Assign):
+                    parts.append("assignment")
+                # You can add more logic here to normalize other structures
+
+            normalized_code = " ".join(parts)
+            self._normalized[code] = normalized_code
+        return normalized_code
 
     def calculate_similarity(self, code1, code2):
         """
@@ -90,16 +103,14 @@ def main():
         similar_pairs = []
 
         # Check for semantic duplication between function pairs
-        for i, func1 in enumerate(functions):
-            for j, func2 in enumerate(functions):
-                if i < j:  # Compare each pair only once
-                    code1 = func1['code']
-                    code2 = func2['code']
-                    
-                    are_duplicate = detector.are_functions_semantically_duplicate(code1, code2)
-                    
-                    if are_duplicate:
-                        similar_pairs.append((func1['name'], func2['name']))
+        for func1, func2 in combinations(functions, 2):  # Compare each pair only once
+            code1 = func1['code']
+            code2 = func2['code']
+
+            are_duplicate = detector.are_functions_semantically_duplicate(code1, code2)
+
+            if are_duplicate:
+                similar_pairs.append((func1['name'], func2['name']))
 
         # Show results of semantic duplication
         if similar_pairs: